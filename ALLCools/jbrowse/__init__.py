@@ -48,13 +48,14 @@ class JBrowse:
         self.verbose = verbose
         self._test_cli()
 
-    def _run_cmd(self, cmd, verbose=None):
+    def _run_cmd(self, cmd, cwd=None, verbose=None):
+        # cmd is an argv list, run without an intermediate shell
         if verbose is None:
             verbose = self.verbose
         if verbose:
-            print(cmd)
+            print(" ".join(map(str, cmd)))
         try:
-            p = subprocess.run(cmd, shell=True, check=True, capture_output=True, encoding="utf-8")
+            p = subprocess.run(cmd, cwd=cwd, check=True, capture_output=True, encoding="utf-8")
             if verbose:
                 print(p.stdout)
                 print(p.stderr)
@@ -64,7 +65,7 @@ class JBrowse:
 
     def _test_cli(self):
         try:
-            self._run_cmd("jbrowse --version")
+            self._run_cmd(["jbrowse", "--version"])
         except Exception as e:
             print(
                 "JBrowse does not seem to be installed. "
@@ -77,7 +78,8 @@ class JBrowse:
         if not self.path.exists():
             self.path.mkdir(parents=True, exist_ok=True)
 
-        self._run_cmd(f"jbrowse create {self.path} && cd {self.path} && npm install -u serve")
+        self._run_cmd(["jbrowse", "create", str(self.path)])
+        self._run_cmd(["npm", "install", "-u", "serve"], cwd=self.path)
 
     def add_assembly(self, fasta_path, name=None, load="symlink"):
         jb_path = self.path / pathlib.Path(fasta_path).name
@@ -87,31 +89,40 @@ class JBrowse:
         if name is None:
             name = pathlib.Path(fasta_path).stem
         self._run_cmd(
-            f"cd {self.path} && "
-            f"jbrowse add-assembly {fasta_path} "
-            f"--name {name} "
-            f"--load {load} "
-            f"--target {self.path}"
+            [
+                "jbrowse",
+                "add-assembly",
+                str(fasta_path),
+                "--name",
+                name,
+                "--load",
+                load,
+                "--target",
+                str(self.path),
+            ],
+            cwd=self.path,
         )
 
     def add_track(self, track_path, name=None, load="symlink", force=False):
         jb_path = self.path / pathlib.Path(track_path).name
         if jb_path.exists():
             load = "inPlace"
-        if force:
-            force_str = "--force"
-        else:
-            force_str = ""
         if name is None:
             name = pathlib.Path(track_path).stem
-        self._run_cmd(
-            f"cd {self.path} && "
-            f"jbrowse add-track {track_path} "
-            f'--name "{name}" '
-            f"--load {load} "
-            f"--target {self.path} "
-            f"{force_str}"
-        )
+        cmd = [
+            "jbrowse",
+            "add-track",
+            str(track_path),
+            "--name",
+            name,
+            "--load",
+            load,
+            "--target",
+            str(self.path),
+        ]
+        if force:
+            cmd.append("--force")
+        self._run_cmd(cmd, cwd=self.path)
 
     def text_index(self):
         jb_path = self.path / "trix"
@@ -119,7 +130,7 @@ class JBrowse:
             print(f"{jb_path} already exists. Skipping.")
             return
 
-        self._run_cmd(f"cd {self.path} && jbrowse text-index")
+        self._run_cmd(["jbrowse", "text-index"], cwd=self.path)
 
     def create(self, fasta_path, gene_gtf, transcript_gtf=None):
         if self.config.exists():
@@ -138,5 +149,5 @@ class JBrowse:
     def serve(self, port=3000):
         if not self.created:
             raise Exception("JBrowse not created yet. Please run create() first.")
-        self._run_cmd(f"cd {self.path} && npx serve -S -p {port} .", verbose=True)
+        self._run_cmd(["npx", "serve", "-S", "-p", str(port), "."], cwd=self.path, verbose=True)
         return
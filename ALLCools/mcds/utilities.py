@@ -1,4 +1,5 @@
 import glob
+import importlib.util
 import json
 import logging
 import pathlib
@@ -10,11 +11,17 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 import yaml
+from numba import njit, prange
+from scipy.spatial import cKDTree
 
 log = logging.getLogger()
 
 
 def calculate_posterior_mc_frac(mc_da, cov_da, var_dim=None, normalize_per_cell=True, clip_norm_value=10):
+    # float32 is precise enough for frac and halves the memory traffic of the following reductions
+    mc_da = mc_da.astype(np.float32, copy=False)
+    cov_da = cov_da.astype(np.float32, copy=False)
+
     # so we can do post_frac only in a very small set of gene to prevent memory issue
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
@@ -91,63 +98,102 @@ def calculate_posterior_mc_frac_lazy(
 
     Running calculate_posterior_mc_rate with dask array and directly save to disk.
     This is highly memory efficient. Use this for dataset larger than machine memory.
+    Dask backed input keeps its own chunks, in-memory input is chunked by dask_cell_chunk cells.
+    cell_chunk is no longer used, the whole dataset is written by one dask computation.
     """
-    cell_list = mc_da.get_index("cell")
-    cell_chunks = [cell_list[i : i + cell_chunk] for i in range(0, cell_list.size, cell_chunk)]
-
-    output_paths = []
-    for chunk_id, cell_list_chunk in enumerate(cell_chunks):
-        _mc_da = mc_da.sel(cell=cell_list_chunk)
-        _cov_da = cov_da.sel(cell=cell_list_chunk)
-        post_rate = calculate_posterior_mc_frac(
-            mc_da=_mc_da,
-            cov_da=_cov_da,
-            var_dim=var_dim,
-            normalize_per_cell=normalize_per_cell,
-            clip_norm_value=clip_norm_value,
+    # let dask run the whole computation, the per-cell prior is a regular dask reduction over var_dim
+    post_rate = calculate_posterior_mc_frac(
+        mc_da=mc_da if mc_da.chunks else mc_da.chunk({"cell": dask_cell_chunk}),
+        cov_da=cov_da if cov_da.chunks else cov_da.chunk({"cell": dask_cell_chunk}),
+        var_dim=var_dim,
+        normalize_per_cell=normalize_per_cell,
+        clip_norm_value=clip_norm_value,
+    )
+    if post_rate.name is None:
+        post_rate.name = f"{var_dim}_da_frac"
+    output_path = output_prefix + f".{var_dim}_da_frac.mcds"
+
+    # align the on-disk chunks with the dask_cell_chunk used to read it back,
+    # chunksizes encoding is only supported by the netCDF4 engine, otherwise use the engine default layout
+    to_netcdf_kwargs = {}
+    if importlib.util.find_spec("netCDF4") is not None:
+        chunksizes = tuple(
+            min(dask_cell_chunk, size) if dim == "cell" else size for dim, size in post_rate.sizes.items()
         )
-        if len(cell_chunks) == 1:
-            chunk_id = ""
-        else:
-            chunk_id = f".{chunk_id}"
-        output_path = output_prefix + f".{var_dim}_da_frac{chunk_id}.mcds"
+        to_netcdf_kwargs = {"engine": "netcdf4", "encoding": {post_rate.name: {"chunksizes": chunksizes}}}
 
-        # to_netcdf trigger the dask computation, and save output directly into disk, quite memory efficient
-        post_rate.to_netcdf(output_path)
-        output_paths.append(output_path)
+    # to_netcdf trigger the dask computation, and save output directly into a single file, quite memory efficient
+    post_rate.to_netcdf(output_path, **to_netcdf_kwargs)
 
-    chunks = {"cell": dask_cell_chunk}
-    total_post_rate = xr.concat([xr.open_dataarray(path, chunks=chunks) for path in output_paths], dim="cell")
+    total_post_rate = xr.open_dataarray(output_path, chunks={"cell": dask_cell_chunk})
     return total_post_rate
 
 
 def calculate_gch_rate(mcds, var_dim="chrom100k"):
-    rate_da = mcds.sel(mc_type=["GCHN", "HCHN"]).add_mc_rate(
-        dim=var_dim, da=f"{var_dim}_da", normalize_per_cell=False, inplace=False
+    da = mcds[f"{var_dim}_da"].sel(mc_type=["GCHN", "HCHN"])
+    rate_da = calculate_posterior_mc_frac(
+        mc_da=da.sel(count_type="mc"), cov_da=da.sel(count_type="cov"), var_dim=var_dim, normalize_per_cell=False
     )
     # (PCG - PCH) / (1 - PCH)
-    real_gc_rate = (rate_da.sel(mc_type="GCHN") - rate_da.sel(mc_type="HCHN")) / (1 - rate_da.sel(mc_type="HCHN"))
-    real_gc_rate = real_gc_rate.transpose("cell", var_dim).values
-    real_gc_rate[real_gc_rate < 0] = 0
+    gchn_rate = rate_da.sel(mc_type="GCHN", drop=True)
+    hchn_rate = rate_da.sel(mc_type="HCHN", drop=True)
+    real_gc_rate = (gchn_rate - hchn_rate) / (1 - hchn_rate)
+    real_gc_rate = real_gc_rate.clip(min=0)
 
     # norm per cell
-    cell_overall_count = mcds[f"{var_dim}_da"].sel(mc_type=["GCHN", "HCHN"]).sum(dim=var_dim)
+    cell_overall_count = da.sum(dim=var_dim)
     cell_overall_rate = cell_overall_count.sel(count_type="mc") / cell_overall_count.sel(count_type="cov")
-    gchn = cell_overall_rate.sel(mc_type="GCHN")
-    hchn = cell_overall_rate.sel(mc_type="HCHN")
-    overall_gchn = (gchn - hchn) / (1 - hchn)
-    real_gc_rate = real_gc_rate / overall_gchn.values[:, None]
+    gchn = cell_overall_rate.sel(mc_type="GCHN", drop=True)
+    hchn = cell_overall_rate.sel(mc_type="HCHN", drop=True)
+    # counts give float64 here, keep the rate dtype
+    overall_gchn = ((gchn - hchn) / (1 - hchn)).astype(real_gc_rate.dtype)
+    # stay lazy if mcds is dask backed, the caller decide when to compute
+    real_gc_rate = (real_gc_rate / overall_gchn).transpose("cell", var_dim)
     return real_gc_rate
 
 
+@njit(parallel=True)
+def _nan_sum_and_square_sum(x, block_size=256):
+    """Sum, sum of square and non-na count of each column in x (obs, var), in a single pass."""
+    n_obs, n_var = x.shape
+    stats = np.zeros((3, n_var), dtype=np.float64)
+    n_block = (n_var + block_size - 1) // block_size
+    for b in prange(n_block):
+        # each block covers adjacent columns, so the inner loop reads x row by row
+        start = b * block_size
+        end = min(start + block_size, n_var)
+        for i in range(n_obs):
+            for j in range(start, end):
+                v = x[i, j]
+                if not np.isnan(v):
+                    stats[0, j] += v
+                    stats[1, j] += v * v
+                    stats[2, j] += 1
+    return stats
+
+
 def get_mean_dispersion(x, obs_dim):
-    # mean
-    mean = x.mean(dim=obs_dim).load()
+    x = x.transpose(obs_dim, ...)
+    if isinstance(x.data, np.ndarray):
+        stats = _nan_sum_and_square_sum(x.data)
+    else:
+        # assume dask array, reduce each obs chunk in one pass, then add up the partial stats
+        data = x.data
+        partial_stats = data.map_blocks(
+            _nan_sum_and_square_sum, chunks=((3,) * data.numblocks[0], data.chunks[1]), dtype=np.float64
+        )
+        stats = partial_stats.reshape(data.numblocks[0], 3, data.shape[1]).sum(axis=0).compute()
+
+    template = x.isel({obs_dim: 0}, drop=True)
+    dtype = x.dtype if np.issubdtype(x.dtype, np.floating) else np.float64
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # mean and mean of square skip na, same as xarray
+        mean = xr.DataArray((stats[0] / stats[2]).astype(dtype), coords=template.coords, dims=template.dims)
+        mean_sq = xr.DataArray((stats[1] / stats[2]).astype(dtype), coords=template.coords, dims=template.dims)
     abs_mean = np.abs(mean)
 
     # var
     # enforce R convention (unbiased estimator) for variance
-    mean_sq = (x * x).mean(dim=obs_dim).load()
     var = (mean_sq - abs_mean**2) * (x.sizes[obs_dim] / (x.sizes[obs_dim] - 1))
 
     # now actually compute the dispersion
@@ -220,9 +266,7 @@ def highly_variable_methylation_feature(
     df["cov_bin"] = (df["cov"] / cov_binsize).astype(int)
 
     # save bin_count df, gather bins with more than bin_min_features features
-    bin_count = (
-        df.groupby(["mean_bin", "cov_bin"]).apply(lambda i: i.shape[0]).reset_index().sort_values(0, ascending=False)
-    )
+    bin_count = df.groupby(["mean_bin", "cov_bin"]).size().reset_index(name=0).sort_values(0, ascending=False)
     bin_count.head()
     bin_more_than = bin_count[bin_count[0] > bin_min_features]
     if bin_more_than.shape[0] == 0:
@@ -230,14 +274,11 @@ def highly_variable_methylation_feature(
 
     # for those bin have too less features, merge them with closest bin in manhattan distance
     # this usually don't cause much difference (a few hundred features), but the scatter plot will look more nature
-    index_map = {}
-    for _, (mean_id, cov_id, count) in bin_count.iterrows():
-        if count > 1:
-            index_map[(mean_id, cov_id)] = (mean_id, cov_id)
-        manhattan_dist = (bin_more_than["mean_bin"] - mean_id).abs() + (bin_more_than["cov_bin"] - cov_id).abs()
-        closest_more_than = manhattan_dist.sort_values().index[0]
-        closest = bin_more_than.loc[closest_more_than]
-        index_map[(mean_id, cov_id)] = tuple(closest.tolist()[:2])
+    # bins in bin_more_than have distance 0 to themselves, so they map to themselves
+    all_bins = bin_count[["mean_bin", "cov_bin"]].values
+    more_than_bins = bin_more_than[["mean_bin", "cov_bin"]].values
+    _, closest = cKDTree(more_than_bins).query(all_bins, k=1, p=1)
+    index_map = dict(zip(map(tuple, all_bins.tolist()), map(tuple, more_than_bins[closest].tolist())))
     # apply index_map to original df
     raw_bin = df[["mean_bin", "cov_bin"]].set_index(["mean_bin", "cov_bin"])
     raw_bin["use_mean"] = pd.Series(index_map).apply(lambda i: i[0])
@@ -251,8 +292,9 @@ def highly_variable_methylation_feature(
     disp_std_bin = disp_grouped.std(ddof=1)
 
     # actually do the normalization
-    _mean_norm = disp_mean_bin.loc[list(zip(df["mean_bin"], df["cov_bin"]))]
-    _std_norm = disp_std_bin.loc[list(zip(df["mean_bin"], df["cov_bin"]))]
+    feature_bins = pd.MultiIndex.from_arrays([df["mean_bin"].values, df["cov_bin"].values])
+    _mean_norm = disp_mean_bin.reindex(feature_bins)
+    _std_norm = disp_std_bin.reindex(feature_bins)
     df["dispersion_norm"] = (
         df["dispersion"].values - _mean_norm.values  # use values here as index differs
     ) / _std_norm.values
@@ -260,7 +302,16 @@ def highly_variable_methylation_feature(
 
     # Select n_top_feature
     if n_top_feature is not None:
-        feature_subset = df.index.isin(df.sort_values("dispersion_norm", ascending=False).index[:5000])
+        # np.partition find the n_top_feature cutoff in O(N), no need to sort all features
+        all_disp_norm = df["dispersion_norm"].values
+        valid_disp_norm = all_disp_norm[~np.isnan(all_disp_norm)]
+        n_top_feature = min(n_top_feature, valid_disp_norm.size)
+        if n_top_feature <= 0:
+            # nothing to select, or all normalized dispersions are na
+            feature_subset = np.zeros(all_disp_norm.size, dtype=bool)
+        else:
+            disp_cut_off = np.partition(valid_disp_norm, -n_top_feature)[-n_top_feature]
+            feature_subset = np.nan_to_num(all_disp_norm, nan=-np.inf) >= disp_cut_off
     else:
         max_disp = np.inf if max_disp is None else max_disp
         dispersion_norm[np.isnan(dispersion_norm)] = 0  # similar to Seurat
@@ -1,47 +1,109 @@
 import anndata
 import numpy as np
 import pandas as pd
-from scipy.sparse import csr_matrix, issparse, vstack
-from sklearn.cluster import MiniBatchKMeans
+from numba import njit, prange
+from scipy.sparse import csr_matrix, issparse
+from sklearn.cluster import MiniBatchKMeans, kmeans_plusplus
+
+
+# fastmath without ninf and nnan, so distance comparisons stay well-defined
+@njit(parallel=True, fastmath={"nsz", "arcp", "contract", "afn", "reassoc"})
+def _kmeans_lloyd(x, centroids, n_iter=20):
+    """Plain Lloyd k-means on a dense matrix, centroids are updated in place."""
+    n, d = x.shape
+    k = centroids.shape[0]
+    labels = np.full(n, -1, dtype=np.int64)
+    for _ in range(n_iter):
+        # assignment step, rows are independent
+        new_labels = np.empty(n, dtype=np.int64)
+        for i in prange(n):
+            best = 0
+            best_dist = 0.0
+            for f in range(d):
+                diff = x[i, f] - centroids[0, f]
+                best_dist += diff * diff
+            for j in range(1, k):
+                dist = 0.0
+                for f in range(d):
+                    diff = x[i, f] - centroids[j, f]
+                    dist += diff * diff
+                if dist < best_dist:
+                    best_dist = dist
+                    best = j
+            new_labels[i] = best
+        converged = (new_labels == labels).all()
+        labels = new_labels
+        if converged:
+            break
+
+        # update step, accumulate per cluster sums in a second pass
+        sums = np.zeros((k, d), dtype=np.float64)
+        counts = np.zeros(k, dtype=np.int64)
+        for i in range(n):
+            c = labels[i]
+            counts[c] += 1
+            for f in range(d):
+                sums[c, f] += x[i, f]
+        for j in range(k):
+            # empty cluster keep its previous centroid
+            if counts[j] > 0:
+                for f in range(d):
+                    centroids[j, f] = sums[j, f] / counts[j]
+    return labels
 
 
-def _kmeans_division(matrix, cells, max_pseudo_size, max_k=50):
+def _kmeans_division(matrix, cells, max_pseudo_size, max_k=50, max_lloyd_size=50000):
     if max_pseudo_size <= 1:
         return "|" + pd.Series(range(cells.size), index=cells).astype(str)
-    labels = pd.Series(index=cells)
-    to_process = [(cells, "")]
+    # one MiniBatchKMeans for the whole tree, only n_clusters and init_size change per node;
+    # random_state is an int, so every fit is seeded the same way as a fresh instance
+    mbk = MiniBatchKMeans(
+        init="k-means++",
+        max_iter=100,
+        batch_size=100,
+        verbose=0,
+        compute_labels=True,
+        random_state=0,
+        tol=0.0,
+        max_no_improvement=10,
+        n_init=5,
+        reassignment_ratio=0.1,
+    )
+
+    # track integer row positions instead of cell names, so each node slices matrix directly
+    labels = np.empty(cells.size, dtype=object)
+    to_process = [(np.arange(cells.size), "")]
     while len(to_process) > 0:
-        curr_cells, curr_prefix = to_process.pop()
-        curr_matrix = matrix[cells.isin(curr_cells)]
+        curr_idx, curr_prefix = to_process.pop()
+        if curr_idx.size <= max_pseudo_size:
+            # nodes of at most max_pseudo_size cells are already valid groups, skip k-means
+            labels[curr_idx] = curr_prefix + "|0"
+            continue
+        curr_matrix = matrix[curr_idx]
 
         # MiniBatchKMeans causes seg fault with huge k; bound with max_k
-        k = min(len(curr_cells) // max_pseudo_size + 1, max_k)
-
-        mbk = MiniBatchKMeans(
-            n_clusters=k,
-            init="k-means++",
-            max_iter=100,
-            batch_size=100,
-            verbose=0,
-            compute_labels=True,
-            random_state=0,
-            tol=0.0,
-            max_no_improvement=10,
-            init_size=3 * k,
-            n_init=5,
-            reassignment_ratio=0.1,
-        )
-
-        mbk.fit(curr_matrix)
-        curr_labels = curr_prefix + "|" + pd.Series(mbk.labels_).astype(str)
-        labels.loc[curr_cells] = curr_labels.tolist()
-        curr_labels = labels.loc[curr_cells]
-
-        for cluster_label, cluster_cells in curr_labels.groupby(curr_labels):
-            if cluster_cells.size <= max_pseudo_size:
+        k = min(curr_idx.size // max_pseudo_size + 1, max_k)
+
+        if curr_idx.size < max_lloyd_size:
+            # moderate size node, full Lloyd iterations are cheaper than MiniBatchKMeans init,
+            # seeded with k-means++ like the MiniBatchKMeans path
+            centroids, _ = kmeans_plusplus(curr_matrix, k, random_state=0)
+            centroids = centroids.astype(np.float64)
+            kmeans_labels = _kmeans_lloyd(curr_matrix, centroids)
+        else:
+            mbk.set_params(n_clusters=k, init_size=3 * k)
+            mbk.fit(curr_matrix)
+            kmeans_labels = mbk.labels_
+        curr_labels = curr_prefix + "|" + kmeans_labels.astype(str).astype(object)
+        labels[curr_idx] = curr_labels
+
+        for cluster_label in np.unique(kmeans_labels):
+            cluster_idx = curr_idx[kmeans_labels == cluster_label]
+            if cluster_idx.size <= max_pseudo_size:
                 continue
             else:
-                to_process.append((cluster_cells.index, cluster_label))
+                to_process.append((cluster_idx, f"{curr_prefix}|{cluster_label}"))
+    labels = pd.Series(labels, index=cells)
     return labels
 
 
@@ -49,11 +111,19 @@ def _calculate_pseudo_group(clusters, total_matrix, cluster_size_cutoff=100, max
     cluster_cells = clusters.value_counts()
     max_pseudo_sizes = (cluster_cells // cluster_size_cutoff + 1).astype(int)
     max_pseudo_sizes[max_pseudo_sizes > max_pseudo_size] = max_pseudo_size
+    total_matrix = np.ascontiguousarray(total_matrix, dtype=np.float32)
+
+    # integer positions of all clusters in one pass
+    cluster_indices = clusters.groupby(clusters, observed=True).indices
 
     records = []
     for cluster, max_pseudo_size in max_pseudo_sizes.items():
-        cells = clusters[clusters == cluster].index
-        matrix = total_matrix[clusters == cluster].copy()
+        if cluster not in cluster_indices:
+            # unused category of a categorical clusters
+            continue
+        idx = cluster_indices[cluster]
+        cells = clusters.index[idx]
+        matrix = total_matrix[idx]
         record = _kmeans_division(matrix, cells, max_pseudo_size)
         record = record.apply(lambda i: f"{cluster}::{i}")
         records.append(record)
@@ -64,43 +134,51 @@ def _calculate_pseudo_group(clusters, total_matrix, cluster_size_cutoff=100, max
 def _merge_pseudo_cell(adata, aggregate_func, pseudo_group_key):
     is_sparse = issparse(adata.X)
     # merge ia to balanced ia (bia)
-    balanced_matrix = []
-    obs = {}
-    for group, cells in adata.obs_names.groupby(adata.obs[pseudo_group_key]).items():
-        n_cells = cells.size
-        if cells.size == 1:
-            group_data = adata.var_vector(cells[0]).ravel()
+    group_ids, groups = pd.factorize(adata.obs[pseudo_group_key], sort=True)
+    n_groups = groups.size
+    cell_idx = np.flatnonzero(group_ids >= 0)
+    group_ids = group_ids[cell_idx]
+    n_cells = np.bincount(group_ids, minlength=n_groups)
+    # factorize return Categorical uniques for categorical key, keep a plain str index
+    obs = pd.DataFrame({"n_cells": n_cells}, index=pd.Index(np.asarray(groups, dtype=str)))
+
+    if aggregate_func in ("sum", "mean"):
+        # aggregate all groups with one (group x cell) indicator matrix product
+        if aggregate_func == "sum":
+            dtype = adata.X.dtype
+            data = np.ones(cell_idx.size, dtype=dtype)
         else:
-            if aggregate_func == "sum":
-                try:
-                    group_data = adata[cells, :].X.sum(axis=0).A1
-                except AttributeError:
-                    group_data = np.array(adata[cells, :].X.sum(axis=0)).ravel()
-            elif aggregate_func == "mean":
-                try:
-                    group_data = adata[cells, :].X.mean(axis=0).A1
-                except AttributeError:
-                    group_data = np.array(adata[cells, :].X.mean(axis=0)).ravel()
-            elif aggregate_func == "median":
-                try:
-                    group_data = adata[cells, :].X.median(axis=0).A1
-                except AttributeError:
-                    group_data = np.array(adata[cells, :].X.median(axis=0)).ravel()
-            elif aggregate_func == "downsample":
-                cell = np.random.choice(cells, 1)
-                try:
-                    group_data = adata[cell, :].X.sum(axis=0).A1  # just to reduce dim
-                except AttributeError:
-                    group_data = np.array(adata[cell, :].X).ravel()
-            else:
-                raise ValueError(f'aggregate_func can only be ["sum", "mean", "median"], got "{aggregate_func}"')
-        balanced_matrix.append(csr_matrix(group_data))
-        obs[group] = {"n_cells": n_cells}
-    balanced_matrix = vstack(balanced_matrix)
-    if not is_sparse:
+            dtype = adata.X.dtype if np.issubdtype(adata.X.dtype, np.floating) else np.float64
+            data = (1 / n_cells[group_ids]).astype(dtype)
+        selector = csr_matrix((data, (group_ids, cell_idx)), shape=(n_groups, adata.n_obs))
+        balanced_matrix = selector @ adata.X
+    elif aggregate_func in ("downsample", "median"):
+        # integer row positions of each group, index adata.X directly instead of building AnnData views
+        order = np.argsort(group_ids, kind="stable")
+        group_cells = np.split(cell_idx[order], np.cumsum(n_cells)[:-1])
+        if aggregate_func == "downsample":
+            selected = [cells[0] if cells.size == 1 else np.random.choice(cells, 1)[0] for cells in group_cells]
+            balanced_matrix = adata.X[selected]
+        else:
+            # median has no closed form, aggregate group by group
+            balanced_matrix = []
+            for cells in group_cells:
+                group_data = adata.X[cells]
+                if issparse(group_data):
+                    group_data = group_data.toarray()
+                balanced_matrix.append(np.median(group_data, axis=0))
+            balanced_matrix = np.vstack(balanced_matrix)
+    else:
+        raise ValueError(f'aggregate_func can only be ["sum", "mean", "median"], got "{aggregate_func}"')
+
+    if is_sparse:
+        balanced_matrix = csr_matrix(balanced_matrix)
+    elif issparse(balanced_matrix):
         balanced_matrix = balanced_matrix.toarray()
+    else:
+        balanced_matrix = np.asarray(balanced_matrix)
 
-    pseudo_cell_adata = anndata.AnnData(balanced_matrix, obs=pd.DataFrame(obs).T, var=adata.var.copy())
+    pseudo_cell_adata = anndata.AnnData(balanced_matrix, obs=obs, var=adata.var.copy())
     return pseudo_cell_adata
 
 
@@ -119,6 +197,9 @@ def generate_pseudo_cells(
     then run k-means clustering iteratively on clusters with size > cluster_size_cutoff,
     the k-means clusters are called cell groups, and the maximum cell group size < max_pseudo_size,
     Finally, we generate a new adata for the balanced dataset.
+    Clusters with less than 50000 cells are split by full Lloyd k-means (k-means++ seeded) instead of
+    MiniBatchKMeans, which gives more even splits, so the cell groups tend to be fewer and larger,
+    but still bounded by max_pseudo_size.
 
     Parameters
     ----------
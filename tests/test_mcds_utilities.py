@@ -0,0 +1,33 @@
+import numpy as np
+import xarray as xr
+
+from ALLCools.mcds.utilities import highly_variable_methylation_feature
+
+
+def _feature_data(n_cell=200, n_feature=2000):
+    rng = np.random.default_rng(0)
+    frac = rng.beta(2, 5, (n_cell, n_feature)) * rng.uniform(0.2, 5, n_feature)
+    features = [f"feature{i}" for i in range(n_feature)]
+    x = xr.DataArray(frac.astype(np.float32), dims=["cell", "feature"], coords={"feature": features})
+    cov = xr.DataArray(rng.lognormal(4, 1.5, n_feature), dims=["feature"], coords={"feature": features})
+    return x, cov
+
+
+def test_hvf_n_top_feature():
+    x, cov = _feature_data()
+    df = highly_variable_methylation_feature(x, cov, n_top_feature=100)
+    assert df["feature_select"].sum() == 100
+    expected = df["dispersion_norm"].sort_values(ascending=False).index[:100]
+    assert df.index[df["feature_select"]].sort_values().equals(expected.sort_values())
+
+
+def test_hvf_n_top_feature_empty():
+    x, cov = _feature_data()
+    df = highly_variable_methylation_feature(x, cov, n_top_feature=0)
+    assert df["feature_select"].sum() == 0
+
+    # all zero features give na dispersion
+    x = x * 0
+    df = highly_variable_methylation_feature(x, cov, n_top_feature=100)
+    assert df["dispersion_norm"].isna().all()
+    assert df["feature_select"].sum() == 0
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+
+from ALLCools.pseudo_cell.pseudo_cell_kmeans import _kmeans_division, _kmeans_lloyd
+
+
+def test_kmeans_lloyd_labels():
+    rng = np.random.default_rng(0)
+    centers = np.array([[0, 0], [10, 10], [-10, 10]], dtype=np.float32)
+    true_labels = np.repeat(np.arange(3), 50)
+    x = (centers[true_labels] + rng.normal(scale=0.5, size=(150, 2))).astype(np.float32)
+    init = x[[0, 50, 100]].astype(np.float64)
+    labels = _kmeans_lloyd(x, init)
+    assert (labels == true_labels).all()
+
+
+def test_kmeans_division_group_size():
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(2000, 10)).astype(np.float32)
+    cells = pd.Index([f"cell{i}" for i in range(2000)])
+    labels = _kmeans_division(matrix, cells, max_pseudo_size=20)
+    assert labels.index.equals(cells)
+    assert labels.notna().all()
+    assert labels.value_counts().max() <= 20